@@ -1,7 +1,13 @@
 import os
 import json
+import asyncio
+import base64
+import fcntl
 import random
 import re
+import struct
+import zlib
+from bisect import bisect_right
 from datetime import datetime, date, timedelta
 from math import ceil
 from zoneinfo import ZoneInfo
@@ -9,7 +15,8 @@ from zoneinfo import ZoneInfo
 from aiogram import Bot, Dispatcher, types
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
-from aiogram.filters import Command
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.filters import Command, Filter
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
@@ -42,6 +49,18 @@ DEBTORS_FILE      = os.path.join(BASE_DIR, "debtors.json")     # должник
 SIM_DATE_FILE     = os.path.join(BASE_DIR, "sim_date.txt")     # «симулируемая» дата для тестов
 STUDENTS_FILE     = os.path.join(BASE_DIR, "students.txt")     # список студентов (Фамилия Имя [Отчество])
 SCHEDULE_FILE     = os.path.join(BASE_DIR, "schedule.json")    # расписание (по дням недели/датам)
+LOCK_FILE         = os.path.join(BASE_DIR, "dutybot.lock")     # блокировка ведущего процесса
+BROADCAST_FILE    = os.path.join(BASE_DIR, "broadcast.json")   # незавершённая рассылка
+
+# чаты для /broadcast через запятую (по умолчанию — только GROUP_ID)
+BROADCAST_CHATS = {int(x) for x in os.getenv("BROADCAST_CHATS", "").replace(" ", "").split(",") if x} or {GROUP_ID}
+# сколько сообщений рассылки отправлять одновременно
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+
+# как часто проверять students.txt / schedule.json на изменения (сек)
+WATCH_INTERVAL = float(os.getenv("WATCH_INTERVAL", "5"))
+# как часто резервный процесс пытается стать ведущим (сек)
+LOCK_RETRY = float(os.getenv("LOCK_RETRY", "5"))
 
 os.makedirs(BASE_DIR, exist_ok=True)
 
@@ -68,8 +87,11 @@ def load_json(fname: str, default):
     return default
 
 def save_json(fname: str, data):
-    with open(fname, "w", encoding="utf-8") as f:
+    # пишем во временный файл и подменяем: читатель никогда не увидит файл наполовину
+    tmp = fname + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, fname)
 
 def load_start_date() -> date:
     if os.path.exists(START_DATE_FILE):
@@ -157,19 +179,42 @@ def idx_to_name(idx: int) -> str:
 # =====================
 #      ГЛОБАЛЬНОЕ
 # =====================
-START_DATE = load_start_date()
-exceptions: dict[str, list[str]] = load_json(EXCEPTIONS_FILE, {})
-_raw_debtors = load_json(DEBTORS_FILE, [])
-debtors: list[int] = []
-for item in _raw_debtors:
-    if isinstance(item, int):
-        debtors.append(item)
-    elif isinstance(item, str):
-        try:
-            debtors.append(name_to_idx(item))
-        except Exception:
-            pass
-save_json(DEBTORS_FILE, debtors)
+# должники, которых сейчас нет в students.txt: держим по имени, чтобы не потерять,
+# если строку убрали ненадолго; вернутся в debtors, когда имя снова появится
+_missing_debtors: list[str] = []
+
+def save_debtors():
+    save_json(DEBTORS_FILE, debtors + _missing_debtors)
+
+def _load_debtors() -> list[int]:
+    global _missing_debtors
+    raw = load_json(DEBTORS_FILE, [])
+    res: list[int] = []
+    missing: list[str] = []
+    for item in raw:
+        if isinstance(item, int):
+            res.append(item)
+        elif isinstance(item, str):
+            try:
+                res.append(name_to_idx(item))
+            except Exception:
+                missing.append(item)
+    _missing_debtors = missing
+    # только читаем: при импорте блокировки ещё нет, и писать сюда может лишь
+    # ведущий процесс; имена перезапишутся индексами при его следующем сохранении
+    return res
+
+def load_state():
+    # состояние ротации; перечитывается, когда процесс становится ведущим
+    global START_DATE, exceptions, debtors
+    START_DATE = load_start_date()
+    exceptions = load_json(EXCEPTIONS_FILE, {})
+    debtors = _load_debtors()
+
+START_DATE: date
+exceptions: dict[str, list[str]]
+debtors: list[int]
+load_state()
 
 # расписание
 _schedule = load_json(SCHEDULE_FILE, {
@@ -254,13 +299,59 @@ WEEKDAY_MAP_RU = {
     "вс":"sun","воскресенье":"sun",
 }
 
+def build_range_index(ranges: list) -> tuple[list[int], list[tuple[date, dict] | None]]:
+    """Интервальный индекс по диапазонам из _schedule["ranges"].
+    Режем диапазоны на непересекающиеся куски: starts — отсортированные начала кусков
+    (ordinal), owners — (дата начала диапазона, сам диапазон) или None для дыр.
+    При пересечении побеждает диапазон, записанный в файле позже."""
+    parsed = []
+    for r in ranges:
+        try:
+            a = datetime.strptime(r["from"], "%Y-%m-%d").date()
+            b = datetime.strptime(r["to"], "%Y-%m-%d").date() if r.get("to") else date.max
+        except (KeyError, TypeError, ValueError):
+            continue
+        if b >= a:
+            parsed.append((a.toordinal(), b.toordinal(), (a, r)))
+    bounds = sorted({a for a, _, _ in parsed} | {b + 1 for _, b, _ in parsed})
+    starts, owners = [], []
+    for lo in bounds:
+        owner = None
+        for a, b, item in parsed:
+            if a <= lo <= b:
+                owner = item
+        if owners and owners[-1] is owner:
+            continue
+        starts.append(lo)
+        owners.append(owner)
+    return starts, owners
+
+_range_index = build_range_index(_schedule.get("ranges", []))
+
+def rebuild_range_index():
+    global _range_index
+    _range_index = build_range_index(_schedule.get("ranges", []))
+
+def range_for_date(d: date) -> tuple[date, dict] | None:
+    starts, owners = _range_index
+    i = bisect_right(starts, d.toordinal()) - 1
+    return owners[i] if i >= 0 else None
+
 def schedule_for_date(d: date) -> list[str]:
-    # приоритет: конкретная дата, иначе по дню недели
+    # приоритет: конкретная дата, затем диапазон (с циклом из N недель), иначе по дню недели
     key = fmt_ymd(d)
     if "dates" in _schedule and key in _schedule["dates"]:
         return _schedule["dates"][key]
     wd = d.weekday()  # 0-пн … 6-вс
     wd_key = WEEKDAY_KEYS[wd]
+    found = range_for_date(d)
+    if found:
+        start, r = found
+        weeks = r.get("weeks") or [r]
+        # недели считаем с понедельника той недели, где начинается диапазон
+        week = weeks[((d - start).days + start.weekday()) // 7 % len(weeks)]
+        if wd_key in week:
+            return week[wd_key]
     return _schedule.get(wd_key, [])
 
 def format_schedule(d: date) -> str:
@@ -280,18 +371,65 @@ def set_weekday_schedule(day_key: str, subjects: list[str]) -> None:
     _schedule[key] = subjects
     save_json(SCHEDULE_FILE, _schedule)
 
+def set_range(d_from: date, d_to: date, n_weeks: int | None = None, force: bool = False) -> int:
+    """Создаёт диапазон [d_from, d_to] с циклом из n_weeks недель или меняет длину цикла у существующего.
+    n_weeks=None — у нового диапазона 1 неделя, у существующего длина не меняется.
+    Заполненные недели при укорачивании удаляются только с force. Возвращает длину цикла."""
+    if d_to < d_from:
+        raise ValueError("Конец диапазона раньше начала")
+    if n_weeks is not None and n_weeks < 1:
+        raise ValueError("Недель в цикле должно быть хотя бы 1")
+    ranges = _schedule.setdefault("ranges", [])
+    for r in ranges:
+        if r.get("from") == fmt_ymd(d_from) and r.get("to") == fmt_ymd(d_to):
+            break
+    else:
+        r = {"from": fmt_ymd(d_from), "to": fmt_ymd(d_to)}
+        ranges.append(r)
+    if "weeks" not in r:
+        r["weeks"] = [{k: r.pop(k) for k in WEEKDAY_KEYS if k in r}]
+    weeks = r["weeks"]
+    if n_weeks is None:
+        n_weeks = len(weeks)
+    dropped = [i for i, week in enumerate(weeks[n_weeks:], n_weeks + 1) if week]
+    if dropped and not force:
+        raise ValueError(f"В неделях {', '.join(map(str, dropped))} есть расписание — "
+                         f"чтобы удалить его, добавь в конце команды «!»")
+    weeks[:] = weeks[:n_weeks] + [{} for _ in range(n_weeks - len(weeks))]
+    save_json(SCHEDULE_FILE, _schedule)
+    rebuild_range_index()
+    return n_weeks
+
+def set_range_week_schedule(d: date, week_no: int, day_key: str, subjects: list[str]) -> None:
+    """Расписание дня недели в неделе week_no (с 1) цикла того диапазона, куда попадает d."""
+    key = day_key.lower()
+    key = WEEKDAY_MAP_RU.get(key, key)
+    if key not in WEEKDAY_KEYS:
+        raise ValueError("Неверный день недели")
+    found = range_for_date(d)
+    if not found:
+        raise ValueError(f"На {fmt_ddmmyyyy(d)} нет диапазона, создай его через /schedule_range")
+    r = found[1]
+    if "weeks" not in r:
+        r["weeks"] = [{k: r.pop(k) for k in WEEKDAY_KEYS if k in r}]
+    if not 1 <= week_no <= len(r["weeks"]):
+        raise ValueError(f"Неделя должна быть от 1 до {len(r['weeks'])}")
+    r["weeks"][week_no - 1][key] = subjects
+    save_json(SCHEDULE_FILE, _schedule)
+    rebuild_range_index()
+
 # =====================
 #     ДОЛЖНИКИ
 # =====================
 def add_debtor_idx(idx: int):
     if idx not in debtors:
         debtors.append(idx)
-        save_json(DEBTORS_FILE, debtors)
+        save_debtors()
 
 def pop_debtor_idx(idx: int):
     if idx in debtors:
         debtors.remove(idx)
-        save_json(DEBTORS_FILE, debtors)
+        save_debtors()
 
 def next_replacement(absent_idx: int, current_pair_names: list[str]) -> int:
     n = len(DUTY_LIST)
@@ -329,17 +467,179 @@ def carry_over_person_to_next_day(person: str, from_date: date):
         N = next_workday(N)
         tried += 1
 
+# =====================
+#  ПЕРЕЧИТЫВАНИЕ ФАЙЛОВ
+# =====================
+def read_schedule_file() -> dict | None:
+    # в отличие от load_json: битый/недописанный файл не подменяем дефолтом
+    try:
+        with open(SCHEDULE_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return data if isinstance(data, dict) else None
+
+def apply_students(new_list: list[str]) -> dict | None:
+    """Применяет новый список учеников, перенумеровывая должников по именам.
+    Должники, которых нет в новом списке, не удаляются, а ждут в _missing_debtors.
+    Возвращает {"added", "removed", "reordered"} или None, если список пуст."""
+    global DUTY_LIST, debtors, _missing_debtors
+    if not new_list:
+        # пустой файл — скорее всего его сейчас переписывают, оставляем старый
+        return None
+    old_keys = {_canon_name(n): i for i, n in enumerate(DUTY_LIST)}
+    new_keys = {_canon_name(n): i for i, n in enumerate(new_list)}
+    diff = {
+        "added": [n for n in new_list if _canon_name(n) not in old_keys],
+        "removed": [n for n in DUTY_LIST if _canon_name(n) not in new_keys],
+        "reordered": [k for k in old_keys if k in new_keys] != [k for k in new_keys if k in old_keys],
+    }
+    if new_list == DUTY_LIST:
+        return diff
+    # должники хранятся индексами — переводим их на новые позиции
+    new_debtors: list[int] = []
+    new_missing: list[str] = []
+    for name in [DUTY_LIST[i % len(DUTY_LIST)] for i in debtors] + _missing_debtors:
+        j = new_keys.get(_canon_name(name))
+        if j is None:
+            if name not in new_missing:
+                new_missing.append(name)
+        elif j not in new_debtors:
+            new_debtors.append(j)
+    DUTY_LIST = new_list
+    if new_debtors != debtors or new_missing != _missing_debtors:
+        debtors, _missing_debtors = new_debtors, new_missing
+        save_debtors()
+    return diff
+
+def format_students_diff(diff: dict) -> str:
+    parts = []
+    if diff["added"]:
+        parts.append("добавлены: " + ", ".join(diff["added"]))
+    if diff["removed"]:
+        parts.append("убраны: " + ", ".join(diff["removed"]))
+    if diff["reordered"]:
+        parts.append("изменён порядок")
+    return "; ".join(parts) if parts else "без изменений"
+
+def apply_schedule(new: dict) -> list[str]:
+    """Заменяет расписание на new, возвращает изменившиеся ключи (дни недели, даты, "ranges")."""
+    changed = [k for k in WEEKDAY_KEYS if _schedule.get(k, []) != new.get(k, [])]
+    old_dates = _schedule.get("dates", {})
+    new_dates = new.get("dates", {})
+    changed += sorted(k for k in set(old_dates) | set(new_dates) if old_dates.get(k) != new_dates.get(k))
+    if _schedule.get("ranges", []) != new.get("ranges", []):
+        changed.append("ranges")
+    if changed:
+        _schedule.clear()
+        _schedule.update(new)
+        rebuild_range_index()
+    return changed
+
+def _file_sig(fname: str) -> tuple[int, int] | None:
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+async def watch_files():
+    # опрос mtime/размера: два маленьких файла, раз в несколько секунд — это почти бесплатно.
+    # Читаем файл, только когда он не менялся два опроса подряд, чтобы не поймать его недописанным
+    applied = {fname: _file_sig(fname) for fname in (STUDENTS_FILE, SCHEDULE_FILE)}
+    seen = dict(applied)
+    while True:
+        await asyncio.sleep(WATCH_INTERVAL)
+        for fname in applied:
+            sig = _file_sig(fname)
+            if sig != seen[fname]:
+                seen[fname] = sig
+                continue
+            if sig is None or sig == applied[fname]:
+                continue
+            applied[fname] = sig
+            try:
+                if fname == STUDENTS_FILE:
+                    diff = apply_students(await asyncio.to_thread(load_students))
+                    if diff is not None:
+                        print(f"🔁 students.txt: {format_students_diff(diff)}")
+                else:
+                    new = await asyncio.to_thread(read_schedule_file)
+                    if new is not None:
+                        changed = apply_schedule(new)
+                        if changed:
+                            print(f"🔁 schedule.json: {', '.join(changed)}")
+            except Exception as e:
+                print(f"❌ Не удалось перечитать {os.path.basename(fname)}: {e}")
+
+# =====================
+#   CALLBACK-ДАННЫЕ
+# =====================
+# callback_data = base64(действие:1 байт, день:4 байта, id учеников по 4 байта).
+# id ученика — crc32 от нормализованного имени, поэтому кнопки не ломаются,
+# когда список учеников переставили. Самая длинная кнопка (replace) — 18 символов
+# при лимите Telegram в 64 байта.
+ACT_OK, ACT_NO, ACT_WIPE, ACT_COME, ACT_REPLACE = range(1, 6)
+ACT_ARITY = {ACT_OK: 1, ACT_NO: 1, ACT_WIPE: 0, ACT_COME: 1, ACT_REPLACE: 2}
+RANDOM_ID = 0xFFFFFFFF                      # «КАЗИНО» вместо конкретного ученика
+def student_id(name: str) -> int:
+    return zlib.crc32(_canon_name(name).encode("utf-8"))
+
+_ids_for: tuple[list[str] | None, dict[int, str]] = (None, {})
+
+def student_by_id(sid: int) -> str | None:
+    global _ids_for
+    if _ids_for[0] is not DUTY_LIST:
+        _ids_for = (DUTY_LIST, {student_id(n): n for n in DUTY_LIST})
+    return _ids_for[1].get(sid)
+
+def encode_callback(action: int, day: date | None = None, *ids: int) -> str:
+    raw = struct.pack(">B", action)
+    if day is not None:
+        raw += struct.pack(">I", day.toordinal())  # ordinal: любая дата от 0001-01-01
+    raw += struct.pack(f">{len(ids)}I", *ids)
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+def decode_callback(data: str) -> tuple[int, tuple[int, ...], date | None] | None:
+    """(действие, id учеников, день) или None, если данные битые/устаревшие."""
+    try:
+        raw = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+    except ValueError:
+        return None
+    if not raw or raw[0] not in ACT_ARITY:
+        return None
+    action, n = raw[0], ACT_ARITY[raw[0]]
+    if n == 0:
+        return (action, (), None) if len(raw) == 1 else None
+    if len(raw) != 5 + 4 * n:
+        return None
+    ordinal = struct.unpack_from(">I", raw, 1)[0]
+    if not 1 <= ordinal <= date.max.toordinal():
+        return None
+    day = date.fromordinal(ordinal)
+    return action, struct.unpack_from(f">{n}I", raw, 5), day
+
+class CallbackAction(Filter):
+    """Пропускает callback с одним из actions и передаёт в хендлер уже разобранный cb."""
+    def __init__(self, *actions: int):
+        self.actions = actions
+
+    async def __call__(self, callback: types.CallbackQuery) -> bool | dict:
+        cb = decode_callback(callback.data or "")
+        if cb is None or cb[0] not in self.actions:
+            return False
+        return {"cb": cb}
+
 # =====================
 #     ИНТЕРФЕЙС
 # =====================
 def build_keyboard(for_date: date, pair_names: list[str]) -> types.InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
-    dstr = for_date.strftime("%Y%m%d")
     for name in pair_names:
-        idx = name_to_idx(name)
-        kb.button(text=f"✅ {name}", callback_data=f"ok:{idx}:{dstr}")
-        kb.button(text=f"❌ {name}", callback_data=f"no:{idx}:{dstr}")
-    kb.button(text="🧨 Полный ресет", callback_data="wipe:all")
+        sid = student_id(name)
+        kb.button(text=f"✅ {name}", callback_data=encode_callback(ACT_OK, for_date, sid))
+        kb.button(text=f"❌ {name}", callback_data=encode_callback(ACT_NO, for_date, sid))
+    kb.button(text="🧨 Полный ресет", callback_data=encode_callback(ACT_WIPE))
     kb.adjust(2, 2, 1)
     return kb.as_markup()
 
@@ -358,45 +658,125 @@ async def send_and_pin(bot: Bot, for_date: date | None = None):
     except Exception:
         pass
 
+# =====================
+#      РАССЫЛКА
+# =====================
+_broadcast_task: asyncio.Task | None = None  # держим ссылку, чтобы задачу не собрал GC
+
+def new_broadcast(text: str, report_chat: int) -> dict:
+    state = {
+        "text": text,
+        "report_chat": report_chat,
+        "total": len(BROADCAST_CHATS),
+        "pending": sorted(BROADCAST_CHATS),
+        "sent": 0,
+        "failed": {},
+    }
+    save_json(BROADCAST_FILE, state)
+    return state
+
+def format_broadcast(state: dict, done: bool = False) -> str:
+    head = "📣 Рассылка завершена" if done else "📣 Рассылка"
+    text = f"{head}: {state['sent']}/{state['total']}, ошибок: {len(state['failed'])}"
+    if done and state["failed"]:
+        text += "\n" + "\n".join(f"- {chat}: {err}" for chat, err in list(state["failed"].items())[:20])
+    return text
+
+async def _broadcast_one(bot: Bot, state: dict, chat_id: int, sem: asyncio.Semaphore):
+    async with sem:
+        while True:
+            try:
+                await bot.send_message(chat_id, state["text"])
+                state["sent"] += 1
+                break
+            except TelegramRetryAfter as e:
+                # флуд-контроль Telegram: ждём сколько сказали и пробуем снова
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                state["failed"][str(chat_id)] = str(e)
+                break
+        state["pending"].remove(chat_id)
+        # после каждого чата — на диск, чтобы после перезапуска не слать повторно
+        save_json(BROADCAST_FILE, state)
+
+async def run_broadcast(bot: Bot, state: dict):
+    """Рассылает state["text"] по всем чатам из state["pending"] не больше чем
+    в BROADCAST_CONCURRENCY потоков, показывая прогресс в state["report_chat"]."""
+    cancelled = False
+    try:
+        try:
+            progress = await bot.send_message(state["report_chat"], format_broadcast(state))
+        except Exception:
+            # без сообщения с прогрессом рассылка всё равно идёт
+            progress = None
+        sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        jobs = asyncio.gather(*(_broadcast_one(bot, state, chat_id, sem) for chat_id in list(state["pending"])),
+                              return_exceptions=True)
+        while not jobs.done():
+            await asyncio.wait([jobs], timeout=2)
+            if progress is not None and not jobs.done():
+                try:
+                    await progress.edit_text(format_broadcast(state))
+                except Exception:
+                    pass
+        # итог всегда отдельной правкой: при досылке пустого pending цикл выше не крутится
+        if progress is not None:
+            try:
+                await progress.edit_text(format_broadcast(state, done=True))
+            except Exception:
+                pass
+        errors = [r for r in jobs.result() if isinstance(r, Exception)]
+        if errors:
+            print(f"❌ Рассылка: {len(errors)} сбоев, первый: {errors[0]!r}")
+    except asyncio.CancelledError:
+        # процесс останавливают — файл оставляем, после перезапуска дошлём
+        cancelled = True
+        raise
+    except Exception as e:
+        print(f"❌ Рассылка прервана: {e!r}")
+    finally:
+        # иначе зависший broadcast.json навсегда блокирует /broadcast
+        if not cancelled and os.path.exists(BROADCAST_FILE):
+            os.remove(BROADCAST_FILE)
+
 # =====================
 #   CALLBACK-КНОПКИ
 # =====================
-async def on_callback(callback: types.CallbackQuery):
+async def on_callback(callback: types.CallbackQuery, cb: tuple):
     if callback.from_user.id not in ADMINS:
         await callback.answer("пошел вон", show_alert=True)
         return
 
-    data = callback.data
-    if data == "wipe:all":
+    action, ids, act_date = cb
+    if action == ACT_WIPE:
         global START_DATE, exceptions, debtors
         START_DATE = get_today()
         save_start_date(START_DATE)
         exceptions = {}
         debtors = []
+        _missing_debtors.clear()
         save_json(EXCEPTIONS_FILE, exceptions)
-        save_json(DEBTORS_FILE, debtors)
+        save_debtors()
         save_sim_date(None)
         await callback.message.answer("бам бум.")
         await send_and_pin(callback.bot, get_today())
         await callback.answer()
         return
 
-    try:
-        action, idx_s, dstr = data.split(":")
-        idx = int(idx_s)
-        act_date = datetime.strptime(dstr, "%Y%m%d").date()
-    except Exception:
-        await callback.answer("Ошибка данных", show_alert=True)
+    name = student_by_id(ids[0])
+    if name is None:
+        await callback.answer("Ученика уже нет в списке", show_alert=True)
         return
+    idx = name_to_idx(name)
 
     pair = get_pair(act_date)
 
-    if action == "ok":
+    if action == ACT_OK:
         await callback.message.answer(f"✅ {idx_to_name(idx)} отметил как присутствующего")
         await callback.answer()
         return
 
-    if action == "no":
+    if action == ACT_NO:
         absent_name = idx_to_name(idx)
         await callback.message.answer(f"❌ {absent_name} отмечен как отсутствующий")
         add_debtor_idx(idx)
@@ -459,6 +839,59 @@ async def cmd_schedule_set(message: types.Message):
         return
     await message.reply("✅ Расписание на день обновлено.")
 
+async def cmd_schedule_range(message: types.Message):
+    if message.from_user.id not in ADMINS:
+        return
+    # /schedule_range 2026-09-01 2026-12-28 2 [!]
+    args = message.text.split()
+    force = args[-1] == "!"
+    if force:
+        args.pop()
+    if len(args) == 1:
+        ranges = _schedule.get("ranges", [])
+        if not ranges:
+            await message.reply("Диапазонов нет.")
+            return
+        lines = [f"{i}. {r.get('from')} — {r.get('to') or '…'}, недель в цикле: {len(r.get('weeks') or [r])}"
+                 for i, r in enumerate(ranges, 1)]
+        await message.reply("Диапазоны:\n" + "\n".join(lines))
+        return
+    try:
+        d_from = datetime.strptime(args[1], "%Y-%m-%d").date()
+        d_to = datetime.strptime(args[2], "%Y-%m-%d").date()
+        n_weeks = int(args[3]) if len(args) > 3 else None
+    except (IndexError, ValueError):
+        await message.reply("❌ Использование: /schedule_range YYYY-MM-DD YYYY-MM-DD [недель в цикле] [!]")
+        return
+    try:
+        n_weeks = set_range(d_from, d_to, n_weeks, force)
+    except ValueError as e:
+        await message.reply(f"❌ {e}")
+        return
+    await message.reply(f"✅ Диапазон {fmt_ddmmyyyy(d_from)} — {fmt_ddmmyyyy(d_to)}, недель в цикле: {n_weeks}.")
+
+async def cmd_schedule_week(message: types.Message):
+    if message.from_user.id not in ADMINS:
+        return
+    # /schedule_week 2026-09-01 2 пн математика | русский | физика
+    parts = message.text[len("/schedule_week"):].strip().split(None, 3)
+    if len(parts) < 4:
+        await message.reply("❌ Использование: /schedule_week YYYY-MM-DD <неделя> <день недели> предмет1 | предмет2 | ...")
+        return
+    try:
+        d = datetime.strptime(parts[0], "%Y-%m-%d").date()
+        week_no = int(parts[1])
+    except ValueError:
+        await message.reply("❌ Формат: YYYY-MM-DD и номер недели числом")
+        return
+    subjects = [s.strip() for s in parts[3].split("|") if s.strip()]
+    try:
+        set_range_week_schedule(d, week_no, parts[2], subjects)
+    except ValueError as e:
+        await message.reply(f"❌ {e}")
+        return
+    await message.reply("✅ Расписание недели в диапазоне обновлено.")
+
 async def cmd_who(message: types.Message):
     args = message.text.split()
     if len(args) > 1:
@@ -533,8 +966,9 @@ async def cmd_reset_all(message: types.Message):
     save_start_date(START_DATE)
     exceptions = {}
     debtors = []
+    _missing_debtors.clear()
     save_json(EXCEPTIONS_FILE, exceptions)
-    save_json(DEBTORS_FILE, debtors)
+    save_debtors()
     save_sim_date(None)
     await message.reply("бамбум.")
 
@@ -560,52 +994,53 @@ async def cmd_come(message: types.Message):
         await message.reply("Список должников пуст.")
         return
     kb = InlineKeyboardBuilder()
-    dstr = target_date.strftime("%Y%m%d")
     for i in debtors:
-        kb.button(text=idx_to_name(i), callback_data=f"come:{i}:{dstr}")
-    kb.button(text="КАЗИНО", callback_data=f"come:random:{dstr}")
+        name = idx_to_name(i)
+        kb.button(text=name, callback_data=encode_callback(ACT_COME, target_date, student_id(name)))
+    kb.button(text="КАЗИНО", callback_data=encode_callback(ACT_COME, target_date, RANDOM_ID))
     await message.reply(f"Дата для отработки: {fmt_ddmmyyyy(target_date)}\nВыбери должника:", reply_markup=kb.as_markup())
 
-async def on_come(callback: types.CallbackQuery):
+async def on_come(callback: types.CallbackQuery, cb: tuple):
     if callback.from_user.id not in ADMINS:
         await callback.answer("ПОШЕЛ ВОН", show_alert=True)
         return
-    _, payload, dstr = callback.data.split(":")
-    target_date = datetime.strptime(dstr, "%Y%m%d").date()
+    _, (debtor_sid,), target_date = cb
     pair = get_pair(target_date)
-    if payload == "random":
+    if debtor_sid == RANDOM_ID:
         if not debtors:
             await callback.answer("Список должников пуст.")
             return
-        debtor_idx = random.choice(debtors)
+        debtor_name = idx_to_name(random.choice(debtors))
     else:
-        debtor_idx = int(payload)
-    debtor_name = idx_to_name(debtor_idx)
+        debtor_name = student_by_id(debtor_sid)
+        if debtor_name is None:
+            await callback.answer("Ученика уже нет в списке", show_alert=True)
+            return
+    debtor_sid = student_id(debtor_name)
     kb = InlineKeyboardBuilder()
-    i0 = name_to_idx(pair[0])
-    i1 = name_to_idx(pair[1])
-    kb.button(text=f"↔ Заменить {pair[0]}", callback_data=f"replace:{debtor_idx}:{i0}:{dstr}")
-    kb.button(text=f"↔ Заменить {pair[1]}", callback_data=f"replace:{debtor_idx}:{i1}:{dstr}")
-    kb.button(text="КАЗИНО", callback_data=f"replace:{debtor_idx}:random:{dstr}")
+    kb.button(text=f"↔ Заменить {pair[0]}", callback_data=encode_callback(ACT_REPLACE, target_date, debtor_sid, student_id(pair[0])))
+    kb.button(text=f"↔ Заменить {pair[1]}", callback_data=encode_callback(ACT_REPLACE, target_date, debtor_sid, student_id(pair[1])))
+    kb.button(text="КАЗИНО", callback_data=encode_callback(ACT_REPLACE, target_date, debtor_sid, RANDOM_ID))
     await callback.message.reply(
         f"Выбран должник: {debtor_name}\nКого заменить {fmt_ddmmyyyy(target_date)}?",
         reply_markup=kb.as_markup()
     )
     await callback.answer()
 
-async def on_replace(callback: types.CallbackQuery):
+async def on_replace(callback: types.CallbackQuery, cb: tuple):
     if callback.from_user.id not in ADMINS:
         await callback.answer("ПОШЕЛ ВОН", show_alert=True)
         return
-    _, debtor_idx_s, target_idx_s, dstr = callback.data.split(":")
-    debtor_idx = int(debtor_idx_s)
-    act_date = datetime.strptime(dstr, "%Y%m%d").date()
+    _, (debtor_sid, target_sid), act_date = cb
+    debtor_name = student_by_id(debtor_sid)
+    target_name = None if target_sid == RANDOM_ID else student_by_id(target_sid)
+    if debtor_name is None or (target_sid != RANDOM_ID and target_name is None):
+        await callback.answer("Ученика уже нет в списке", show_alert=True)
+        return
+    debtor_idx = name_to_idx(debtor_name)
     pair = get_pair(act_date)
-    if target_idx_s == "random":
+    if target_name is None:
         target_name = random.choice(pair)
-    else:
-        target_name = idx_to_name(int(target_idx_s))
-    debtor_name = idx_to_name(debtor_idx)
     new_pair = [debtor_name if x == target_name else x for x in pair]
     set_exception(act_date, new_pair)
     pop_debtor_idx(debtor_idx)
@@ -614,6 +1049,10 @@ async def on_replace(callback: types.CallbackQuery):
     await callback.message.answer(f"Должник {debtor_name} заменил {target_name} ({fmt_ddmmyyyy(act_date)}).")
     await callback.answer()
 
+async def on_stale_callback(callback: types.CallbackQuery):
+    # кнопки старого формата (replace:…, ok:… и т.п.) с уже отправленных постов
+    await callback.answer("Кнопка устарела, открой свежий пост.", show_alert=True)
+
 async def cmd_say(message: types.Message):
     if message.from_user.id not in ADMINS:
         return
@@ -624,12 +1063,28 @@ async def cmd_say(message: types.Message):
     await message.bot.send_message(GROUP_ID, text)
     await message.reply("✅ Отправлено.")
 
+async def cmd_broadcast(message: types.Message):
+    if message.from_user.id not in ADMINS:
+        return
+    text = message.text[len("/broadcast"):].strip()
+    if not text:
+        await message.reply("❌ Использование: /broadcast текст")
+        return
+    if os.path.exists(BROADCAST_FILE):
+        await message.reply("❌ Предыдущая рассылка ещё не закончилась.")
+        return
+    global _broadcast_task
+    state = new_broadcast(text, message.chat.id)
+    _broadcast_task = asyncio.create_task(run_broadcast(message.bot, state))
+
 async def cmd_reload_students(message: types.Message):
     if message.from_user.id not in ADMINS:
         return
-    global DUTY_LIST
-    DUTY_LIST = load_students()
-    await message.reply(f"🔁 Перечитал students.txt. Всего: {len(DUTY_LIST)}")
+    diff = apply_students(load_students())
+    if diff is None:
+        await message.reply("❌ students.txt пуст — оставил прежний список.")
+        return
+    await message.reply(f"🔁 Перечитал students.txt ({format_students_diff(diff)}). Всего: {len(DUTY_LIST)}")
 
 # seed / seed_only с гибким распознаванием имён
 DATE_AT_END_RE = re.compile(r"\s(\d{4}-\d{2}-\d{2})$")
@@ -704,7 +1159,44 @@ async def cmd_seed_only(message: types.Message):
 # =====================
 #       ЗАПУСК
 # =====================
+def try_acquire_leader_lock():
+    """Эксклюзивная flock-блокировка на LOCK_FILE. Держит её только один процесс;
+    ОС снимает блокировку сама, если процесс умер. None — уже занято."""
+    fd = open(LOCK_FILE, "a+")
+    try:
+        fcntl.flock(fd.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        fd.close()
+        return None
+    fd.truncate(0)
+    fd.write(str(os.getpid()))
+    fd.flush()
+    return fd
+
+async def wait_for_leadership():
+    # getUpdates и ежедневный пост допускают ровно одного владельца на токен,
+    # остальные копии ждут в резерве и подхватывают работу, если ведущий упал
+    lock = try_acquire_leader_lock()
+    if lock is not None:
+        return lock
+    print("⏸ Уже запущен другой экземпляр, жду в резерве")
+    while lock is None:
+        await asyncio.sleep(LOCK_RETRY)
+        lock = try_acquire_leader_lock()
+    # пока ждали, ведущий мог всё поменять — перечитываем файлы.
+    # Список берём как есть, без apply_students: debtors.json ведущий уже
+    # сохранил в индексах нового списка, повторная перенумерация их сломает
+    global DUTY_LIST
+    DUTY_LIST = load_students() or DUTY_LIST
+    load_state()
+    new = read_schedule_file()
+    if new is not None:
+        apply_schedule(new)
+    return lock
+
 async def main():
+    lock = await wait_for_leadership()
+
     dp = Dispatcher()
     bot = Bot(TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 
@@ -714,6 +1206,8 @@ async def main():
     dp.message.register(cmd_tomorrow,      Command("tomorrow"))
     dp.message.register(cmd_schedule,      Command("schedule"))
     dp.message.register(cmd_schedule_set,  Command("schedule_set"))
+    dp.message.register(cmd_schedule_range, Command("schedule_range"))
+    dp.message.register(cmd_schedule_week, Command("schedule_week"))
     dp.message.register(cmd_who,           Command("who"))
     dp.message.register(cmd_send,          Command("send"))
     dp.message.register(cmd_next,          Command("next"))
@@ -726,11 +1220,13 @@ async def main():
     dp.message.register(cmd_seed,          Command("seed"))
     dp.message.register(cmd_seed_only,     Command("seed_only"))
     dp.message.register(cmd_say,           Command("say"))
+    dp.message.register(cmd_broadcast,     Command("broadcast"))
 
     # коллбеки
-    dp.callback_query.register(on_callback, lambda c: c.data.startswith(("ok:", "no:", "wipe:")))
-    dp.callback_query.register(on_come,     lambda c: c.data.startswith("come:"))
-    dp.callback_query.register(on_replace,  lambda c: c.data.startswith("replace:"))
+    dp.callback_query.register(on_callback, CallbackAction(ACT_OK, ACT_NO, ACT_WIPE))
+    dp.callback_query.register(on_come,     CallbackAction(ACT_COME))
+    dp.callback_query.register(on_replace,  CallbackAction(ACT_REPLACE))
+    dp.callback_query.register(on_stale_callback)
 
     # расписание: Пн–Сб 00:00 (реальная дата)
     scheduler = AsyncIOScheduler(timezone=TZ)
@@ -743,9 +1239,22 @@ async def main():
     )
     scheduler.start()
 
+    # students.txt / schedule.json подхватываются без перезапуска
+    watcher = asyncio.create_task(watch_files()) if WATCH_INTERVAL > 0 else None
+
+    # рассылка, прерванная перезапуском, досылается оставшимся чатам
+    pending_broadcast = load_json(BROADCAST_FILE, None)
+    if pending_broadcast:
+        global _broadcast_task
+        _broadcast_task = asyncio.create_task(run_broadcast(bot, pending_broadcast))
+
     print("✅ DutyBot 2.0 запущен")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        lock.close()
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(main())